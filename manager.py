@@ -4,11 +4,19 @@ import logging
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from datetime import datetime, timedelta
+from typing import Optional
 import uvicorn
 import os
+import time
 from logging_loki import LokiHandler
 
+# Use uvloop's libuv-based event loop when available (not supported on Windows)
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    uvloop = None
+
 # Import Redis helper
 from redis_helper import RedisManager
 
@@ -16,16 +24,23 @@ from redis_helper import RedisManager
 logger = logging.getLogger("manager")
 logger.setLevel(logging.INFO)
 
-# Add Loki handler
-loki_handler = LokiHandler(
-    url="http://loki:3100/loki/api/v1/push",
-    tags={"application": "manager"},
-    version="1",
-)
-logger.addHandler(loki_handler)
+# Add Loki handler (once, so re-imports don't duplicate every log call)
+if not logger.handlers:
+    loki_handler = LokiHandler(
+        url="http://loki:3100/loki/api/v1/push",
+        tags={"application": "manager"},
+        version="1",
+    )
+    logger.addHandler(loki_handler)
 
 # Environment variables
 HEARTBEAT_TIMEOUT = int(os.getenv("HEARTBEAT_TIMEOUT", 15))  # seconds
+OUTGOING_QUEUE_SIZE = int(os.getenv("OUTGOING_QUEUE_SIZE", 1024))  # messages per worker
+# Must stay below HEARTBEAT_TIMEOUT so flushed heartbeats never look stale in Redis
+STATE_FLUSH_INTERVAL = int(os.getenv("STATE_FLUSH_INTERVAL", max(1, HEARTBEAT_TIMEOUT // 3)))  # seconds
+if STATE_FLUSH_INTERVAL >= HEARTBEAT_TIMEOUT:
+    STATE_FLUSH_INTERVAL = max(1, HEARTBEAT_TIMEOUT // 3)
+    logger.warning(f"STATE_FLUSH_INTERVAL must be below HEARTBEAT_TIMEOUT, using {STATE_FLUSH_INTERVAL}s")
 
 app = FastAPI(title="FastAPI Workers Manager")
 
@@ -45,14 +60,20 @@ class WorkerInfo(BaseModel):
     host: str
     port: int
     status: str = "registered"
-    last_heartbeat: str = None
+    last_heartbeat: Optional[float] = None  # epoch seconds
 
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: dict[str, WebSocket] = {}
+        # In-process source of truth for connected workers:
+        # worker_id -> {"websocket", "status", "last_heartbeat", "dirty"}
+        # Redis is written on status transitions and by the periodic flush
+        self.worker_state: dict[str, dict] = {}
+        self.out_queues: dict[str, asyncio.Queue] = {}
+        self.out_tasks: dict[str, asyncio.Task] = {}
         self.redis = RedisManager()
         self.worker_status_task = None
+        self.flush_task = None
     
     async def connect_redis(self):
         """Connect to Redis"""
@@ -61,54 +82,180 @@ class ConnectionManager:
     async def connect(self, websocket: WebSocket, worker_id: str):
         """Connect a worker via WebSocket"""
         await websocket.accept()
-        self.active_connections[worker_id] = websocket
+        # A reconnecting worker reuses its ID; retire the connection it replaces
+        previous = self.worker_state.get(worker_id)
+        previous_sender = self.out_tasks.get(worker_id)
+        self.worker_state[worker_id] = {
+            "websocket": websocket,
+            "status": "connected",
+            "last_heartbeat": time.time(),
+            "dirty": False,
+        }
+        queue = asyncio.Queue(maxsize=OUTGOING_QUEUE_SIZE)
+        self.out_queues[worker_id] = queue
+        self.out_tasks[worker_id] = asyncio.create_task(self._sender(worker_id, websocket, queue))
+        if previous is not None:
+            # The new state is already in place, so the old endpoint's disconnect is a no-op
+            if previous_sender:
+                previous_sender.cancel()
+            try:
+                await asyncio.wait_for(previous["websocket"].close(), timeout=1)
+            except Exception:
+                pass
+            logger.info(f"Worker {worker_id} reconnected, replaced previous connection")
         logger.info(f"Worker {worker_id} connected")
         
-    async def disconnect(self, worker_id: str):
+    async def disconnect(self, worker_id: str, websocket: WebSocket):
         """Handle worker disconnect"""
-        if worker_id in self.active_connections:
-            del self.active_connections[worker_id]
+        # Ignore a stale connection that was already replaced by a reconnect
+        state = self.worker_state.get(worker_id)
+        if state is not None and state["websocket"] is websocket:
+            del self.worker_state[worker_id]
+            self.out_queues.pop(worker_id, None)
+            sender_task = self.out_tasks.pop(worker_id, None)
+            if sender_task:
+                sender_task.cancel()
             logger.info(f"Worker {worker_id} disconnected")
             await self.update_worker_status(worker_id, "disconnected")
             
+    async def _sender(self, worker_id: str, websocket: WebSocket, queue: asyncio.Queue):
+        """Drain a worker's outgoing queue, coalescing queued messages into one frame"""
+        try:
+            while True:
+                message = await queue.get()
+                extras = []
+                while not queue.empty():
+                    extras.append(queue.get_nowait())
+                await websocket.send_json({"batch": [message, *extras]} if extras else message)
+        except Exception as e:
+            logger.error(f"Error sending to worker {worker_id}: {e}")
+            # Stop accepting messages for this connection and close it so the
+            # endpoint's receive loop ends and runs the normal disconnect path
+            if self.out_queues.get(worker_id) is queue:
+                del self.out_queues[worker_id]
+                self.out_tasks.pop(worker_id, None)
+            try:
+                await websocket.close()
+            except Exception:
+                pass
+            
+    def send(self, worker_id: str, message: dict) -> bool:
+        """Queue a message for a connected worker without waiting for the send"""
+        queue = self.out_queues.get(worker_id)
+        if queue is None:
+            return False
+        try:
+            queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            logger.warning(f"Outgoing queue full for worker {worker_id}, dropping message")
+            return False
+            
+    def broadcast(self, message: dict):
+        """Queue a message for every connected worker"""
+        for worker_id in list(self.out_queues):
+            self.send(worker_id, message)
+            
     async def update_worker_status(self, worker_id: str, status: str):
         """Update worker status in Redis"""
         await self.redis.update_worker_status(worker_id, status)
             
-    async def process_heartbeat(self, worker_id: str, data: dict):
+    async def process_heartbeat(self, worker_id: str):
         """Process a heartbeat from a worker"""
-        await self.redis.update_worker_heartbeat(worker_id, "alive")
+        state = self.worker_state.get(worker_id)
+        if state is None:
+            return
+        state["last_heartbeat"] = time.time()
+        # Only write to Redis when the worker becomes alive (first beat or recovery);
+        # otherwise the periodic flush persists the new timestamp
+        if state["status"] != "alive":
+            state["status"] = "alive"
+            state["dirty"] = False
+            await self.redis.update_worker_heartbeat(worker_id, "alive")
+        else:
+            state["dirty"] = True
             
     async def check_worker_status(self):
         """Periodic task to check worker status"""
         while True:
             try:
-                workers = await self.redis.get_all_workers()
-                current_time = datetime.now()
+                current_ts = time.time()
+                stale = []
+                
+                # Connected workers are checked in memory without touching Redis
+                for worker_id, state in self.worker_state.items():
+                    if state["status"] != "not_responding" and current_ts - state["last_heartbeat"] > HEARTBEAT_TIMEOUT:
+                        state["status"] = "not_responding"
+                        stale.append(worker_id)
+                
+                # Registered workers without a connection here are checked via the heartbeat index
+                stale_ids = await self.redis.get_stale_workers(HEARTBEAT_TIMEOUT)
+                stale.extend(worker_id for worker_id in stale_ids if worker_id not in self.worker_state)
+                
+                for worker_id in stale:
+                    logger.warning(f"Worker {worker_id} is not responding. No heartbeat for over {HEARTBEAT_TIMEOUT}s")
                 
-                for worker_id, worker_info in workers.items():
-                    # Skip already disconnected workers
-                    if worker_info["status"] == "disconnected":
-                        continue
-                        
-                    # Check last heartbeat time
-                    if worker_info["last_heartbeat"]:
-                        last_heartbeat = datetime.fromisoformat(worker_info["last_heartbeat"])
-                        time_diff = (current_time - last_heartbeat).total_seconds()
-                        
-                        if time_diff > HEARTBEAT_TIMEOUT:
-                            logger.warning(f"Worker {worker_id} ({worker_info['worker_name']}) is not responding. Last heartbeat: {last_heartbeat}")
-                            await self.redis.update_worker_status(worker_id, "not_responding")
+                # Flush all status changes in one round-trip
+                await self.redis.bulk_update_statuses([(worker_id, "not_responding") for worker_id in stale])
             except Exception as e:
                 logger.error(f"Error checking worker status: {e}")
                 
             await asyncio.sleep(5)  # Check every 5 seconds
             
+    async def flush_worker_state(self):
+        """Periodic task to persist in-memory heartbeat timestamps to Redis"""
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            try:
+                await self.flush_dirty_state()
+            except Exception as e:
+                logger.error(f"Error flushing worker state: {e}")
+                
+    async def flush_dirty_state(self):
+        """Persist heartbeat timestamps changed since the last flush (status is written on transitions only)"""
+        updates = []
+        for worker_id, state in self.worker_state.items():
+            if state["dirty"]:
+                state["dirty"] = False
+                updates.append((worker_id, state["last_heartbeat"]))
+                
+        # All dirty entries go out in one pipelined round-trip
+        await self.redis.bulk_update_heartbeats(updates)
+                
+    async def get_all_workers(self, live_only: bool = False) -> dict:
+        """Get all workers, with in-memory state of connected workers over the Redis records"""
+        if live_only:
+            workers = await self.redis.get_live_workers()
+        else:
+            workers = await self.redis.get_all_workers()
+        for worker_id, state in self.worker_state.items():
+            if worker_id in workers:
+                workers[worker_id]["status"] = state["status"]
+                workers[worker_id]["last_heartbeat"] = state["last_heartbeat"]
+        return workers
+            
     async def start_monitoring(self):
-        """Start the background task for monitoring workers"""
+        """Start the background tasks for monitoring workers"""
         if not self.worker_status_task:
+            # Workers live before a restart are only in Redis; index them so the
+            # ones that don't reconnect are marked not_responding after the timeout
+            await self.redis.seed_heartbeat_index()
             self.worker_status_task = asyncio.create_task(self.check_worker_status())
             logger.info("Worker status monitoring started")
+        if not self.flush_task:
+            self.flush_task = asyncio.create_task(self.flush_worker_state())
+            
+    async def stop_monitoring(self):
+        """Stop the background tasks and persist any unflushed heartbeats"""
+        for task in (self.worker_status_task, self.flush_task):
+            if task:
+                task.cancel()
+        self.worker_status_task = None
+        self.flush_task = None
+        try:
+            await self.flush_dirty_state()
+        except Exception as e:
+            logger.error(f"Error flushing worker state on shutdown: {e}")
 
 
 # Create manager instance
@@ -123,6 +270,13 @@ async def startup_event():
         await manager.start_monitoring()
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop monitoring, flush worker state and close connections on shutdown"""
+    await manager.stop_monitoring()
+    await manager.redis.close()
+
+
 @app.get("/")
 async def root():
     """Root endpoint"""
@@ -130,10 +284,10 @@ async def root():
 
 
 @app.get("/workers")
-async def get_workers():
-    """Get all registered workers"""
+async def get_workers(live: bool = False):
+    """Get all registered workers, or only the status of non-disconnected ones with ?live=true"""
     try:
-        result = await manager.redis.get_all_workers()
+        result = await manager.get_all_workers(live_only=live)
         return result
     except Exception as e:
         logger.error(f"Error getting workers: {e}")
@@ -145,7 +299,7 @@ async def register_worker(worker: WorkerInfo):
     """Register a new worker"""
     try:
         worker_dict = worker.model_dump()
-        worker_dict["last_heartbeat"] = str(datetime.now())
+        worker_dict["last_heartbeat"] = time.time()
         
         success = await manager.redis.register_worker(worker.worker_id, worker_dict)
         if success:
@@ -168,15 +322,19 @@ async def websocket_endpoint(websocket: WebSocket, worker_id: str):
         
         # Handle heartbeats
         while True:
-            data = await websocket.receive_json()
-            await manager.process_heartbeat(worker_id, data)
+            # The heartbeat time is taken server-side, so the payload is not parsed;
+            # any text or binary frame counts as a heartbeat
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            await manager.process_heartbeat(worker_id)
             
     except WebSocketDisconnect:
         logger.info(f"WebSocket disconnected for worker {worker_id}")
-        await manager.disconnect(worker_id)
+        await manager.disconnect(worker_id, websocket)
     except Exception as e:
         logger.error(f"Error in WebSocket connection: {e}")
-        await manager.disconnect(worker_id)
+        await manager.disconnect(worker_id, websocket)
 
 
 if __name__ == "__main__":
@@ -184,5 +342,10 @@ if __name__ == "__main__":
         "manager:app",
         host="0.0.0.0",
         port=8000,
-        reload=True
+        # Auto-reload is for development only. Runs a single process: connected
+        # worker state lives in this process's memory
+        reload=bool(int(os.getenv("DEV", 0))),
+        loop="uvloop" if uvloop else "asyncio",
+        http="httptools",
+        ws="websockets"
     )
@@ -1,60 +1,110 @@
-import json
+import copy
+import hashlib
 import logging
 import os
-from datetime import datetime
-from typing import Dict, Any, Optional
-from logging_loki import LokiHandler
+import time
+from typing import Dict, Any, List, Optional, Tuple
 import asyncio
-import aiohttp
-from logging.handlers import QueueHandler
-import queue
+import httpx
 
 # Try to import redis, but provide fallback for local testing
 try:
     import redis.asyncio as redis
+    from redis.exceptions import NoScriptError
     REDIS_AVAILABLE = True
 except ImportError:
     REDIS_AVAILABLE = False
+    
+    class NoScriptError(Exception):
+        """Stand-in for redis-py's NoScriptError, raised by the in-memory mock"""
     logging.warning("Redis package not available, using in-memory mock instead")
 
-# Create a queue for async logging
-log_queue = queue.Queue()
+# Maximum number of log records shipped to Loki in a single push
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", 100))
+# Maximum number of log records buffered while Loki is slow; oldest are dropped first
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10_000))
+
+
+class AsyncQueueHandler(logging.Handler):
+    """Logging handler that feeds records into an asyncio.Queue drained by process_log_queue"""
+    
+    def __init__(self):
+        super().__init__()
+        self.queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.loop = None
+        
+    def emit(self, record):
+        try:
+            # Render the message now so the record no longer depends on its args
+            record = copy.copy(record)
+            record.msg = self.format(record)
+            record.args = None
+            record.exc_info = None
+            if self.loop is None or self.loop.is_closed() or self._on_loop_thread():
+                self._put(record)
+            else:
+                self.loop.call_soon_threadsafe(self._put, record)
+        except Exception:
+            self.handleError(record)
+            
+    def _put(self, record):
+        """Enqueue a record, dropping the oldest one when the queue is full"""
+        try:
+            self.queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.queue.get_nowait()
+            self.queue.put_nowait(record)
+            
+    def _on_loop_thread(self) -> bool:
+        """Whether emit() is being called from the drain loop's own thread"""
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
 
 # Configure logging with Loki
 logger = logging.getLogger("redis_helper")
 logger.setLevel(logging.INFO)
 
-# Add queue handler
-queue_handler = QueueHandler(log_queue)
-logger.addHandler(queue_handler)
+# Add async queue handler, reusing the one from a previous import so records aren't shipped twice.
+# It is kept on the logger itself: a reload defines a new AsyncQueueHandler class,
+# so an isinstance check would miss the existing handler
+queue_handler = getattr(logger, "_async_queue_handler", None)
+if queue_handler is None:
+    queue_handler = AsyncQueueHandler()
+    logger.addHandler(queue_handler)
+    logger._async_queue_handler = queue_handler
 
-async def send_log_to_loki(log_record):
-    """Async function to send logs to Loki"""
-    async with aiohttp.ClientSession() as session:
-        try:
-            log_data = {
-                "streams": [{
-                    "stream": {"application": "redis_helper"},
-                    "values": [[str(int(datetime.now().timestamp() * 1e9)), log_record.getMessage()]]
-                }]
-            }
-            async with session.post(
-                "http://loki:3100/loki/api/v1/push",
-                json=log_data
-            ) as response:
-                if response.status != 204:
-                    print(f"Failed to send log to Loki: {await response.text()}")
-        except Exception as e:
-            print(f"Error sending log to Loki: {e}")
+async def send_logs_to_loki(client, log_records):
+    """Async function to send a batch of logs to Loki in one push"""
+    try:
+        log_data = {
+            "streams": [{
+                "stream": {"application": "redis_helper"},
+                "values": [[str(int(record.created * 1e9)), record.getMessage()] for record in log_records]
+            }]
+        }
+        response = await client.post(
+            "http://loki:3100/loki/api/v1/push",
+            json=log_data
+        )
+        if response.status_code != 204:
+            print(f"Failed to send logs to Loki: {response.text}")
+    except Exception as e:
+        print(f"Error sending logs to Loki: {e}")
 
-async def process_log_queue():
+async def process_log_queue(client):
     """Process logs from queue and send to Loki"""
+    queue_handler.loop = asyncio.get_running_loop()
+    log_queue = queue_handler.queue
     while True:
         try:
-            log_record = log_queue.get_nowait()
-            await send_log_to_loki(log_record)
-        except queue.Empty:
-            await asyncio.sleep(0.1)
+            # Wait for the first record, then take whatever else is already queued
+            log_records = [await log_queue.get()]
+            while len(log_records) < LOG_BATCH_SIZE and not log_queue.empty():
+                log_records.append(log_queue.get_nowait())
+            await send_logs_to_loki(client, log_records)
         except Exception as e:
             print(f"Error processing log queue: {e}")
             await asyncio.sleep(1)
@@ -64,19 +114,127 @@ REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
 
+# Sorted set of workers not yet seen on a connection to this manager, scored by
+# registration time or, for live workers seeded at startup, their last stored
+# heartbeat; connected workers are tracked in the manager's memory
+HEARTBEAT_INDEX = "workers:heartbeat"
+
+# Each worker is stored as its own hash worker:{id}; this set lists all of them
+WORKER_IDS = "worker_ids"
+# Set of workers that have registered and not disconnected since
+LIVE_WORKERS = "workers:live"
+# Hash fields stored as strings by Redis but read back as numbers
+NUMERIC_FIELDS = {"port": int, "last_heartbeat": float}
+
+# Sets fields on a worker hash and keeps the indexes in step, only if the worker
+# is registered, so an update for an unknown worker creates no record. One round-trip.
+# KEYS[1] = worker hash, KEYS[2] = live set, KEYS[3] = heartbeat index
+# ARGV[1] = worker ID, ARGV[2..] = field/value pairs; the indexes are only touched
+# when the first pair is "status", <status>
+UPDATE_WORKER_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+if ARGV[2] ~= 'status' then return 1 end
+-- Any status change means the worker is no longer just "registered"
+redis.call('ZREM', KEYS[3], ARGV[1])
+if ARGV[3] == 'disconnected' then
+    redis.call('SREM', KEYS[2], ARGV[1])
+else
+    redis.call('SADD', KEYS[2], ARGV[1])
+end
+return 1
+"""
+
+
+def _to_str(value) -> str:
+    """Decode a raw Redis reply (bytes) into str, passing str through unchanged"""
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _worker_key(worker_id: str) -> str:
+    """Redis key of a worker's hash"""
+    return f"worker:{worker_id}"
+
+
+def _decode_worker(raw: Dict[Any, Any]) -> Dict[str, Any]:
+    """Turn a raw worker hash reply into a dict with numeric fields restored"""
+    worker = {_to_str(field): _to_str(value) for field, value in raw.items()}
+    for field, cast in NUMERIC_FIELDS.items():
+        if field in worker:
+            worker[field] = cast(worker[field])
+    return worker
+
+
+class InMemoryPipeline:
+    """Mock Redis pipeline that queues commands and runs them on execute()"""
+    
+    def __init__(self, redis_mock):
+        self.redis_mock = redis_mock
+        self.commands = []
+        
+    async def __aenter__(self):
+        return self
+        
+    async def __aexit__(self, *exc_info):
+        self.commands = []
+        
+    def __await__(self):
+        # Like redis-py's async pipeline, awaiting a queued command yields the pipeline
+        return self._self().__await__()
+        
+    async def _self(self):
+        return self
+        
+    def __getattr__(self, name):
+        method = getattr(self.redis_mock, name)
+        
+        def queue_command(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue_command
+        
+    async def execute(self):
+        """Run all queued commands in order and return their results"""
+        commands, self.commands = self.commands, []
+        return [await method(*args, **kwargs) for method, args, kwargs in commands]
+
+
+class InMemoryScript:
+    """Mock of a redis-py registered script, run through the mock's EVALSHA emulation"""
+    
+    def __init__(self, redis_mock, script):
+        self.redis_mock = redis_mock
+        self.script = script
+        self.sha = hashlib.sha1(script.encode()).hexdigest()
+        redis_mock.scripts[self.sha] = script
+        
+    async def __call__(self, keys=None, args=None, client=None):
+        keys, args = list(keys or []), list(args or [])
+        client = client or self.redis_mock
+        try:
+            return await client.evalsha(self.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            # Like redis-py, reload the script once if it was flushed
+            await self.redis_mock.script_load(self.script)
+            return await client.evalsha(self.sha, len(keys), *keys, *args)
+
 
 class InMemoryRedis:
     """Mock Redis implementation for local testing"""
     
     def __init__(self):
         self.data = {}
+        self.scripts = {}
         
-    async def hset(self, hash_name, key, value):
+    async def hset(self, hash_name, key=None, value=None, mapping=None):
         """Emulates Redis HSET"""
-        if hash_name not in self.data:
-            self.data[hash_name] = {}
-        self.data[hash_name][key] = value
-        return 1
+        fields = dict(mapping or {})
+        if key is not None:
+            fields[key] = value
+        hash_data = self.data.setdefault(hash_name, {})
+        added = sum(1 for field in fields if field not in hash_data)
+        hash_data.update(fields)
+        return added
         
     async def hget(self, hash_name, key):
         """Emulates Redis HGET"""
@@ -88,7 +246,87 @@ class InMemoryRedis:
         """Emulates Redis HGETALL"""
         if hash_name not in self.data:
             return {}
-        return self.data[hash_name]
+        return dict(self.data[hash_name])
+        
+    async def hmget(self, hash_name, keys):
+        """Emulates Redis HMGET"""
+        hash_data = self.data.get(hash_name, {})
+        return [hash_data.get(key) for key in keys]
+        
+    async def exists(self, *names):
+        """Emulates Redis EXISTS"""
+        return sum(1 for name in names if name in self.data)
+        
+    async def sadd(self, set_name, *members):
+        """Emulates Redis SADD"""
+        members_set = self.data.setdefault(set_name, set())
+        added = len(set(members) - members_set)
+        members_set.update(members)
+        return added
+        
+    async def srem(self, set_name, *members):
+        """Emulates Redis SREM"""
+        members_set = self.data.get(set_name, set())
+        removed = len(set(members) & members_set)
+        members_set.difference_update(members)
+        return removed
+        
+    async def smembers(self, set_name):
+        """Emulates Redis SMEMBERS"""
+        return set(self.data.get(set_name, set()))
+        
+    async def zadd(self, set_name, mapping):
+        """Emulates Redis ZADD"""
+        zset = self.data.setdefault(set_name, {})
+        added = sum(1 for member in mapping if member not in zset)
+        zset.update(mapping)
+        return added
+        
+    async def zrem(self, set_name, *members):
+        """Emulates Redis ZREM"""
+        zset = self.data.get(set_name, {})
+        return sum(1 for member in members if zset.pop(member, None) is not None)
+        
+    async def zrangebyscore(self, set_name, min_score, max_score):
+        """Emulates Redis ZRANGEBYSCORE"""
+        min_score, max_score = float(min_score), float(max_score)
+        zset = self.data.get(set_name, {})
+        return [member for member, score in sorted(zset.items(), key=lambda item: item[1])
+                if min_score <= score <= max_score]
+        
+    async def script_load(self, script):
+        """Emulates Redis SCRIPT LOAD for the scripts defined in this module"""
+        sha = hashlib.sha1(script.encode()).hexdigest()
+        self.scripts[sha] = script
+        return sha
+        
+    async def evalsha(self, sha, numkeys, *keys_and_args):
+        """Emulates Redis EVALSHA by running a Python port of the loaded script"""
+        keys, args = keys_and_args[:numkeys], keys_and_args[numkeys:]
+        if sha not in self.scripts:
+            raise NoScriptError("No matching script. Please use EVAL.")
+        if self.scripts[sha] != UPDATE_WORKER_LUA:
+            raise ValueError(f"No emulation for script {sha}")
+        if not await self.exists(keys[0]):
+            return 0
+        worker_id, fields = args[0], args[1:]
+        await self.hset(keys[0], mapping=dict(zip(fields[::2], fields[1::2])))
+        if fields[0] != "status":
+            return 1
+        await self.zrem(keys[2], worker_id)
+        if fields[1] == "disconnected":
+            await self.srem(keys[1], worker_id)
+        else:
+            await self.sadd(keys[1], worker_id)
+        return 1
+        
+    def register_script(self, script):
+        """Emulates redis-py's register_script"""
+        return InMemoryScript(self, script)
+        
+    def pipeline(self, transaction=True):
+        """Emulates Redis PIPELINE"""
+        return InMemoryPipeline(self)
 
 
 class RedisManager:
@@ -98,15 +336,23 @@ class RedisManager:
         self.redis_pool = None
         self.use_mock = not REDIS_AVAILABLE
         self.log_task = None
+        self._loki_client = None
+        self._update_worker = None
         
     async def connect(self) -> bool:
         """Connect to Redis or initialize mock"""
         # Start log processing task
         if not self.log_task:
-            self.log_task = asyncio.create_task(process_log_queue())
+            # One keep-alive client shared by every Loki push
+            self._loki_client = httpx.AsyncClient(
+                timeout=5.0,
+                limits=httpx.Limits(max_keepalive_connections=2)
+            )
+            self.log_task = asyncio.create_task(process_log_queue(self._loki_client))
             
         if self.use_mock:
             self.redis_pool = InMemoryRedis()
+            self._update_worker = self.redis_pool.register_script(UPDATE_WORKER_LUA)
             logger.info("Using in-memory mock for Redis")
             return True
             
@@ -115,42 +361,78 @@ class RedisManager:
                 host=REDIS_HOST,
                 port=REDIS_PORT,
                 db=REDIS_DB,
-                encoding="utf-8",
-                decode_responses=True
+                # Keep replies as bytes; only the fields we read are decoded
+                decode_responses=False
             )
+            # redis-py reloads a registered script if Redis lost it (restart, SCRIPT FLUSH)
+            self._update_worker = self.redis_pool.register_script(UPDATE_WORKER_LUA)
             logger.info(f"Connected to Redis at {REDIS_HOST}:{REDIS_PORT}")
             return True
         except Exception as e:
             logger.error(f"Failed to connect to Redis: {e}")
             # Fall back to mock if Redis connection fails
             self.redis_pool = InMemoryRedis()
+            self._update_worker = self.redis_pool.register_script(UPDATE_WORKER_LUA)
             self.use_mock = True
             logger.info("Falling back to in-memory mock for Redis")
             return True
             
+    async def close(self):
+        """Stop log shipping and close the Loki client and Redis connection"""
+        if self.log_task:
+            self.log_task.cancel()
+            self.log_task = None
+        if self._loki_client:
+            await self._loki_client.aclose()
+            self._loki_client = None
+        if self.redis_pool and not self.use_mock:
+            await self.redis_pool.aclose()
+            
     async def register_worker(self, worker_id: str, worker_data: Dict[str, Any]) -> bool:
         """Register a worker in Redis"""
         try:
-            # Ensure last_heartbeat is set
-            if "last_heartbeat" not in worker_data:
-                worker_data["last_heartbeat"] = str(datetime.now())
+            # Ensure last_heartbeat is set (epoch seconds)
+            if not worker_data.get("last_heartbeat"):
+                worker_data["last_heartbeat"] = time.time()
                 
-            await self.redis_pool.hset("workers", worker_id, json.dumps(worker_data))
+            # Redis hashes can't hold None, so unset fields are simply omitted
+            mapping = {field: value for field, value in worker_data.items() if value is not None}
+            async with self.redis_pool.pipeline(transaction=False) as pipe:
+                pipe.hset(_worker_key(worker_id), mapping=mapping)
+                pipe.sadd(WORKER_IDS, worker_id)
+                pipe.sadd(LIVE_WORKERS, worker_id)
+                pipe.zadd(HEARTBEAT_INDEX, {worker_id: worker_data["last_heartbeat"]})
+                await pipe.execute()
             logger.info(f"Registered worker: {worker_id}")
             return True
         except Exception as e:
             logger.error(f"Error registering worker: {e}")
             return False
             
+    def _update_call(self, worker_id: str, fields: List[Any]) -> Tuple[List[str], List[Any]]:
+        """Build the keys and args of an update-script call for one worker"""
+        return [_worker_key(worker_id), LIVE_WORKERS, HEARTBEAT_INDEX], [worker_id, *fields]
+        
+    async def _run_updates(self, calls: List[Tuple[List[str], List[Any]]]) -> List[Any]:
+        """Run several update-script calls as raw EVALSHAs in one pipelined round-trip"""
+        # A registered script on a pipeline costs an extra SCRIPT EXISTS round-trip,
+        # so the script is only (re)loaded when Redis reports it missing
+        for attempt in range(2):
+            try:
+                async with self.redis_pool.pipeline(transaction=False) as pipe:
+                    for keys, args in calls:
+                        pipe.evalsha(self._update_worker.sha, len(keys), *keys, *args)
+                    return await pipe.execute()
+            except NoScriptError:
+                if attempt:
+                    raise
+                await self.redis_pool.script_load(UPDATE_WORKER_LUA)
+            
     async def update_worker_heartbeat(self, worker_id: str, status: str = "alive") -> bool:
         """Update worker heartbeat timestamp and status"""
         try:
-            worker_data = await self.redis_pool.hget("workers", worker_id)
-            if worker_data:
-                worker_info = json.loads(worker_data)
-                worker_info["status"] = status
-                worker_info["last_heartbeat"] = str(datetime.now())
-                await self.redis_pool.hset("workers", worker_id, json.dumps(worker_info))
+            keys, args = self._update_call(worker_id, ["status", status, "last_heartbeat", time.time()])
+            if await self._update_worker(keys=keys, args=args):
                 logger.debug(f"Updated heartbeat for worker {worker_id}")
                 return True
             else:
@@ -163,11 +445,8 @@ class RedisManager:
     async def update_worker_status(self, worker_id: str, status: str) -> bool:
         """Update worker status"""
         try:
-            worker_data = await self.redis_pool.hget("workers", worker_id)
-            if worker_data:
-                worker_info = json.loads(worker_data)
-                worker_info["status"] = status
-                await self.redis_pool.hset("workers", worker_id, json.dumps(worker_info))
+            keys, args = self._update_call(worker_id, ["status", status])
+            if await self._update_worker(keys=keys, args=args):
                 logger.info(f"Updated status of worker {worker_id} to {status}")
                 return True
             else:
@@ -177,25 +456,112 @@ class RedisManager:
             logger.error(f"Error updating worker status: {e}")
             return False
             
+    async def bulk_update_statuses(self, updates: List[Tuple[str, str]]) -> int:
+        """Update the status of several workers in a single pipelined round-trip"""
+        if not updates:
+            return 0
+        try:
+            results = await self._run_updates([
+                self._update_call(worker_id, ["status", status]) for worker_id, status in updates
+            ])
+            updated = sum(1 for result in results if result)
+            logger.info(f"Updated status of {updated}/{len(updates)} workers")
+            return updated
+        except Exception as e:
+            logger.error(f"Error bulk updating worker status: {e}")
+            return 0
+            
+    async def bulk_update_heartbeats(self, updates: List[Tuple[str, float]]) -> int:
+        """Update the last heartbeat of several workers in a single pipelined round-trip"""
+        if not updates:
+            return 0
+        try:
+            # Status is left alone: a flush racing a disconnect must not revive the worker
+            results = await self._run_updates([
+                self._update_call(worker_id, ["last_heartbeat", last_heartbeat])
+                for worker_id, last_heartbeat in updates
+            ])
+            updated = sum(1 for result in results if result)
+            logger.debug(f"Flushed heartbeats of {updated}/{len(updates)} workers")
+            return updated
+        except Exception as e:
+            logger.error(f"Error bulk updating worker heartbeats: {e}")
+            return 0
+            
+    async def seed_heartbeat_index(self) -> int:
+        """Index live workers by their stored heartbeat so ones that never reconnect go stale"""
+        try:
+            worker_ids = [_to_str(worker_id) for worker_id in await self.redis_pool.smembers(LIVE_WORKERS)]
+            async with self.redis_pool.pipeline(transaction=False) as pipe:
+                for worker_id in worker_ids:
+                    pipe.hmget(_worker_key(worker_id), ["status", "last_heartbeat"])
+                results = await pipe.execute()
+            # Workers already marked not_responding don't need to be caught again
+            mapping = {
+                worker_id: float(last_heartbeat)
+                for worker_id, (status, last_heartbeat) in zip(worker_ids, results)
+                if last_heartbeat is not None and _to_str(status) != "not_responding"
+            }
+            if mapping:
+                await self.redis_pool.zadd(HEARTBEAT_INDEX, mapping)
+            logger.info(f"Seeded heartbeat index with {len(mapping)} live workers")
+            return len(mapping)
+        except Exception as e:
+            logger.error(f"Error seeding heartbeat index: {e}")
+            return 0
+            
+    async def get_stale_workers(self, timeout: float) -> List[str]:
+        """Get IDs of registered workers that have not connected within timeout seconds"""
+        try:
+            stale_ids = await self.redis_pool.zrangebyscore(HEARTBEAT_INDEX, "-inf", time.time() - timeout)
+            return [_to_str(worker_id) for worker_id in stale_ids]
+        except Exception as e:
+            logger.error(f"Error getting stale workers: {e}")
+            return []
+            
     async def get_worker(self, worker_id: str) -> Optional[Dict[str, Any]]:
         """Get worker data from Redis"""
         try:
-            worker_data = await self.redis_pool.hget("workers", worker_id)
+            worker_data = await self.redis_pool.hgetall(_worker_key(worker_id))
             if worker_data:
-                return json.loads(worker_data)
+                return _decode_worker(worker_data)
             return None
         except Exception as e:
             logger.error(f"Error getting worker: {e}")
             return None
             
+    async def get_live_workers(self) -> Dict[str, Dict[str, Any]]:
+        """Get status and last heartbeat of workers that have not disconnected"""
+        try:
+            worker_ids = [_to_str(worker_id) for worker_id in await self.redis_pool.smembers(LIVE_WORKERS)]
+            # Fetch only the two monitored fields of each worker in one pipelined round-trip
+            async with self.redis_pool.pipeline(transaction=False) as pipe:
+                for worker_id in worker_ids:
+                    pipe.hmget(_worker_key(worker_id), ["status", "last_heartbeat"])
+                results = await pipe.execute()
+            return {
+                worker_id: _decode_worker({"status": status, "last_heartbeat": last_heartbeat})
+                for worker_id, (status, last_heartbeat) in zip(worker_ids, results)
+                if status is not None
+            }
+        except Exception as e:
+            logger.error(f"Error getting live workers: {e}")
+            return {}
+            
     async def get_all_workers(self) -> Dict[str, Dict[str, Any]]:
         """Get all workers from Redis"""
         try:
-            workers = await self.redis_pool.hgetall("workers")
-            result = {}
-            for worker_id, worker_data in workers.items():
-                result[worker_id] = json.loads(worker_data)
-            return result
+            worker_ids = [_to_str(worker_id) for worker_id in await self.redis_pool.smembers(WORKER_IDS)]
+            # Fetch every worker hash in one pipelined round-trip
+            async with self.redis_pool.pipeline(transaction=False) as pipe:
+                for worker_id in worker_ids:
+                    pipe.hgetall(_worker_key(worker_id))
+                results = await pipe.execute()
+            return {
+                worker_id: _decode_worker(worker_data)
+                for worker_id, worker_data in zip(worker_ids, results)
+                if worker_data
+            }
         except Exception as e:
             logger.error(f"Error getting all workers: {e}")
             return {}
@@ -1,10 +1,11 @@
 import asyncio
-import json
+import functools
 import logging
 import uuid
 import os
 import random
-from datetime import datetime
+import time
+import orjson
 import websockets
 import uvicorn
 import httpx
@@ -13,20 +14,25 @@ from fastapi.middleware.cors import CORSMiddleware
 import socket
 from logging_loki import LokiHandler
 
-# Import Redis helper if needed (not used in worker yet but prepared for future use)
-from redis_helper import RedisManager
+# Use uvloop's libuv-based event loop when available (not supported on Windows)
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    uvloop = None
 
 # Configure logging with Loki
 logger = logging.getLogger("worker")
 logger.setLevel(logging.INFO)
 
-# Add Loki handler
-loki_handler = LokiHandler(
-    url="http://loki:3100/loki/api/v1/push",
-    tags={"application": "worker"},
-    version="1",
-)
-logger.addHandler(loki_handler)
+# Add Loki handler (once, so re-imports don't duplicate every log call)
+if not logger.handlers:
+    loki_handler = LokiHandler(
+        url="http://loki:3100/loki/api/v1/push",
+        tags={"application": "worker"},
+        version="1",
+    )
+    logger.addHandler(loki_handler)
 
 # Configuration from environment variables
 WORKER_NAME = os.getenv("WORKER_NAME", f"Worker-{random.randint(1, 1000)}")
@@ -34,6 +40,7 @@ WORKER_PORT = int(os.getenv("WORKER_PORT", 8001))
 MANAGER_HOST = os.getenv("MANAGER_HOST", "localhost")
 MANAGER_PORT = int(os.getenv("MANAGER_PORT", 8000))
 HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL", 5))  # seconds
+HEARTBEAT_TIMEOUT = int(os.getenv("HEARTBEAT_TIMEOUT", 15))  # seconds
 
 # Create unique worker ID
 WORKER_ID = str(uuid.uuid4())
@@ -53,9 +60,16 @@ app.add_middleware(
 websocket_task = None
 heartbeat_running = False
 
+# Shared HTTP client so calls to the manager reuse pooled keep-alive connections
+_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_keepalive_connections=5, max_connections=10),
+    timeout=5.0,
+)
+
 
+@functools.lru_cache(maxsize=1)
 def get_host_ip():
-    """Get the host IP address"""
+    """Get the host IP address (blocking DNS lookup, cached after the first call)"""
     try:
         # Get host name 
         host_name = socket.gethostname()
@@ -69,7 +83,8 @@ def get_host_ip():
 async def register_with_manager():
     """Register this worker with the manager service"""
     try:
-        host_ip = get_host_ip()
+        # Resolve in a thread so a slow resolver never blocks the event loop
+        host_ip = await asyncio.get_running_loop().run_in_executor(None, get_host_ip)
         worker_data = {
             "worker_id": WORKER_ID,
             "worker_name": WORKER_NAME,
@@ -78,21 +93,29 @@ async def register_with_manager():
             "status": "registering"
         }
         
-        async with httpx.AsyncClient() as client:
-            url = f"http://{MANAGER_HOST}:{MANAGER_PORT}/register"
-            response = await client.post(url, json=worker_data)
-            
-            if response.status_code == 200:
-                logger.info(f"Successfully registered with manager: {response.json()}")
-                return True
-            else:
-                logger.error(f"Failed to register with manager: {response.text}")
-                return False
+        url = f"http://{MANAGER_HOST}:{MANAGER_PORT}/register"
+        response = await _http_client.post(url, json=worker_data)
+        
+        if response.status_code == 200:
+            logger.info(f"Successfully registered with manager: {response.json()}")
+            return True
+        else:
+            logger.error(f"Failed to register with manager: {response.text}")
+            return False
     except Exception as e:
         logger.error(f"Error registering with manager: {e}")
         return False
 
 
+async def receive_messages(websocket):
+    """Consume messages pushed by the manager over the heartbeat WebSocket"""
+    try:
+        async for message in websocket:
+            logger.debug("Message from manager: %s", message)
+    except websockets.ConnectionClosed:
+        pass
+
+
 async def send_heartbeats():
     """Send heartbeats to manager via WebSocket"""
     global heartbeat_running
@@ -103,28 +126,42 @@ async def send_heartbeats():
         
         logger.info(f"Connecting to WebSocket at {uri}")
         
-        async with websockets.connect(uri) as websocket:
+        # Protocol-level PING/PONG detects a dead manager connection and closes it
+        async with websockets.connect(
+            uri,
+            ping_interval=HEARTBEAT_INTERVAL,
+            ping_timeout=HEARTBEAT_TIMEOUT,
+        ) as websocket:
             logger.info("WebSocket connection established")
             
-            while heartbeat_running:
-                # Create heartbeat data
-                heartbeat_data = {
-                    "timestamp": str(datetime.now()),
-                    "worker_id": WORKER_ID,
-                    "worker_name": WORKER_NAME,
-                    "status": "alive",
-                    "metrics": {
-                        "cpu": random.randint(0, 100),  # Simulate some metrics
-                        "memory": random.randint(100, 500),
-                    }
-                }
-                
-                # Send heartbeat
-                await websocket.send(json.dumps(heartbeat_data))
-                logger.debug(f"Heartbeat sent: {heartbeat_data}")
-                
-                # Wait for next heartbeat
-                await asyncio.sleep(HEARTBEAT_INTERVAL)
+            # Constant fields are serialized once; each beat only splices in
+            # the timestamp and metrics (the prefix drops the closing brace)
+            heartbeat_prefix = orjson.dumps({
+                "worker_id": WORKER_ID,
+                "worker_name": WORKER_NAME,
+                "status": "alive",
+            })[:-1]
+            
+            # Keep reading so manager messages never fill the receive buffer and stall pongs
+            reader_task = asyncio.create_task(receive_messages(websocket))
+            try:
+                while heartbeat_running:
+                    # Create heartbeat data
+                    heartbeat_data = b'%b,"timestamp":%.6f,"metrics":{"cpu":%d,"memory":%d}}' % (
+                        heartbeat_prefix,
+                        time.time(),
+                        random.randint(0, 100),  # Simulate some metrics
+                        random.randint(100, 500),
+                    )
+                    
+                    # Send heartbeat
+                    await websocket.send(heartbeat_data)
+                    logger.debug("Heartbeat sent: %s", heartbeat_data)
+                    
+                    # Wait for next heartbeat
+                    await asyncio.sleep(HEARTBEAT_INTERVAL)
+            finally:
+                reader_task.cancel()
     except Exception as e:
         logger.error(f"Error in heartbeat WebSocket connection: {e}")
         heartbeat_running = False
@@ -170,6 +207,8 @@ async def shutdown_event():
         websocket_task.cancel()
         
     logger.info("Heartbeat task stopped")
+    
+    await _http_client.aclose()
 
 
 @app.get("/")
@@ -193,5 +232,9 @@ if __name__ == "__main__":
         "worker:app",
         host="0.0.0.0",
         port=WORKER_PORT,
-        reload=True
+        # Auto-reload is for development only
+        reload=bool(int(os.getenv("DEV", 0))),
+        loop="uvloop" if uvloop else "asyncio",
+        http="httptools",
+        ws="websockets"
     )